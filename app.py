@@ -1,24 +1,148 @@
 import gradio as gr
 import librosa
 import soundfile as sf
+import math
 import numpy as np
+from scipy import fft as scifft
 from scipy import signal
 
+try:
+    import numba
+    from numba import prange
+except ImportError:  # fall back to the vectorized NumPy paths
+    numba = None
+    prange = range
+
+# Below this many samples per channel, thread start-up outweighs running channels in parallel
+_PARALLEL_MIN_SAMPLES = 1 << 15
+
+
+def _vibrato_gather(y, delay_samples, out):
+    """Read each output sample from its time-varying delayed position in its channel of y"""
+    n = y.shape[1]
+    for c in prange(y.shape[0]):
+        for i in range(n):
+            index = i - delay_samples[i]
+            if 0 <= index < n:
+                out[c, i] = y[c, index]
+
+
+def _sine_osc(freq, sr, depth, out):
+    """Fill out with depth * sin(2*pi*freq*t) using the two-tap recurrence s[n] = 2cos(w)s[n-1] - s[n-2]"""
+    w = 2 * math.pi * freq / sr
+    c = 2 * math.cos(w)
+    s0 = 0.0
+    s1 = depth * math.sin(w)
+    for i in range(out.shape[0]):
+        out[i] = s0
+        s2 = c * s1 - s0
+        s0 = s1
+        s1 = s2
+
+
+def _echo_distort(y, delay_samples, decay, gain, threshold, out):
+    """Echo, gain, clipping and peak normalization in a single walk over each channel of y"""
+    n = y.shape[1]
+    peaks = np.zeros(y.shape[0], dtype=np.float32)
+    for c in prange(y.shape[0]):
+        peak = 0.0
+        for i in range(n):
+            x = y[c, i]
+            if i >= delay_samples:
+                x += decay * y[c, i - delay_samples]
+            x *= gain
+            if x > threshold:
+                x = threshold
+            elif x < -threshold:
+                x = -threshold
+            out[c, i] = x
+            peak = max(peak, abs(x))
+        peaks[c] = peak
+    # One peak across all channels keeps the stereo balance intact
+    scale = 1.0 / max(peaks.max(), 1e-12)
+    for c in prange(y.shape[0]):
+        for i in range(n):
+            out[c, i] *= scale
+
+
+def _absmax(x):
+    """Largest absolute value in x, found in one pass"""
+    peak = 0.0
+    for i in range(x.shape[0]):
+        peak = max(peak, abs(x[i]))
+    return peak
+
+
+def _warmup_kernels():
+    """Run every kernel once on a tiny buffer so the first request pays no JIT cost"""
+    y = np.zeros((2, 16), dtype=np.float32)
+    out = np.empty_like(y)
+    _absmax(y[0])
+    _sine_osc(5.0, 16.0, 0.5, out[0])
+    for gather in (_vibrato_gather, _vibrato_gather_parallel):
+        gather(y, np.zeros(16, dtype=np.int64), out)
+    for echo_distort in (_echo_distort, _echo_distort_parallel):
+        echo_distort(y, 4, 0.5, 1.0, 0.5, out)
+
+
+if numba is not None:
+    # Explicit C-contiguous signatures compile eagerly; cache=True reuses the
+    # machine code on later launches
+    _absmax = numba.njit('f4(f4[::1])', cache=True, fastmath=True, boundscheck=False)(_absmax)
+    _sine_osc = numba.njit('void(f8, f8, f8, f4[::1])', cache=True, fastmath=True,
+                           boundscheck=False)(_sine_osc)
+    # The channel kernels also get a prange build that runs each channel on its own thread
+    _vibrato_gather_parallel = numba.njit('void(f4[:, ::1], i8[::1], f4[:, ::1])', cache=True, fastmath=True,
+                                          boundscheck=False, parallel=True)(_vibrato_gather)
+    _vibrato_gather = numba.njit('void(f4[:, ::1], i8[::1], f4[:, ::1])', cache=True, fastmath=True,
+                                 boundscheck=False)(_vibrato_gather)
+    _echo_distort_parallel = numba.njit('void(f4[:, ::1], i8, f4, f4, f4, f4[:, ::1])', cache=True,
+                                        fastmath=True, boundscheck=False, parallel=True)(_echo_distort)
+    _echo_distort = numba.njit('void(f4[:, ::1], i8, f4, f4, f4, f4[:, ::1])', cache=True, fastmath=True,
+                               boundscheck=False)(_echo_distort)
+    _warmup_kernels()
+
+
 class VoiceEffects:
+    # Butterworth designs keyed on (order, normalized_cutoff, filter_type, sr)
+    _sos_cache = {}
+    # Formant resampling grids (lo, hi, frac, above_nyquist) keyed on (n_bins, shift_factor)
+    _formant_grid_cache = {}
+
     def __init__(self, input_file):
-        self.y, self.sr = librosa.load(input_file, sr=None)
+        try:
+            # Decode straight to float32 at the native rate, skipping librosa's resampler path
+            y, self.sr = sf.read(input_file, dtype='float32', always_2d=True)
+            y = y.T
+        except RuntimeError:
+            # Formats libsndfile cannot decode go through librosa's audioread fallback
+            y, self.sr = librosa.load(input_file, sr=None, mono=False)
+        # Audio is held as (channels, samples) in single precision; mono is one channel
+        self.y = np.ascontiguousarray(np.atleast_2d(y), dtype=np.float32)
+        # Effects that cannot work in place write here and swap it with self.y,
+        # so the chain reuses one spare buffer instead of allocating per effect
+        self._scratch = np.empty_like(self.y)
         
     def add_reverb(self, room_size=0.8, damping=0.5):
         """
-        Add reverb effect using convolution
+        Add reverb effect using FFT convolution
         room_size: controls the size of the simulated room (0 to 1)
         damping: controls how quickly the reverb decays (0 to 1)
         """
-        reverb_len = int(self.sr * room_size)
-        impulse = np.exp(-damping * np.linspace(0, reverb_len, reverb_len))
-        impulse = np.pad(impulse, (0, max(0, len(self.y) - len(impulse))), mode='constant')
-        reverb_signal = signal.convolve(self.y, impulse, mode='same')
-        self.y = 0.6 * self.y + 0.4 * reverb_signal
+        reverb_len = max(1, int(self.sr * room_size))
+        # Signal and impulse both stay float32 so pocketfft runs single-precision transforms
+        impulse = np.exp(-damping * np.linspace(0, reverb_len, reverb_len, dtype=np.float32))
+        y = self.y.astype(np.float32, copy=False)
+        # FFT convolution: overlap-add for short impulses, one big FFT for long ones.
+        # Keep the causal head of the full convolution so the tail follows the dry signal
+        n = y.shape[-1]
+        impulse = impulse[np.newaxis, :]
+        with scifft.set_workers(-1):
+            if reverb_len > 2048:
+                reverb_signal = signal.fftconvolve(y, impulse, axes=-1)[:, :n]
+            else:
+                reverb_signal = signal.oaconvolve(y, impulse, axes=-1)[:, :n]
+        self.y = 0.6 * y + 0.4 * reverb_signal
         
     def apply_frequency_filter(self, cutoff_freq, filter_type='lowpass', order=4):
         """
@@ -29,14 +153,20 @@ class VoiceEffects:
         nyquist = self.sr / 2
         normalized_cutoff = cutoff_freq / nyquist
         
-        if filter_type == 'lowpass':
-            b, a = signal.butter(order, normalized_cutoff, btype='low')
-        elif filter_type == 'highpass':
-            b, a = signal.butter(order, normalized_cutoff, btype='high')
-        elif filter_type == 'bandpass':
-            b, a = signal.butter(order, [normalized_cutoff * 0.5, normalized_cutoff], btype='band')
+        key = (order, normalized_cutoff, filter_type, self.sr)
+        sos = self._sos_cache.get(key)
+        if sos is None:
+            if filter_type == 'lowpass':
+                sos = signal.butter(order, normalized_cutoff, btype='low', output='sos')
+            elif filter_type == 'highpass':
+                sos = signal.butter(order, normalized_cutoff, btype='high', output='sos')
+            elif filter_type == 'bandpass':
+                sos = signal.butter(order, [normalized_cutoff * 0.5, normalized_cutoff], btype='band', output='sos')
+            sos = sos.astype(np.float32)
+            self._sos_cache[key] = sos
             
-        self.y = signal.filtfilt(b, a, self.y)
+        # sosfiltfilt hands back a reversed view; store a C-contiguous float32 copy
+        self.y = np.ascontiguousarray(signal.sosfiltfilt(sos, self.y, axis=-1), dtype=np.float32)
         
     def add_vibrato(self, freq=5.0, depth=0.3):
         """
@@ -44,32 +174,64 @@ class VoiceEffects:
         freq: vibrato frequency in Hz
         depth: vibrato depth (0 to 1)
         """
-        t = np.arange(len(self.y)) / self.sr
-        mod = depth * np.sin(2 * np.pi * freq * t)
-        delay_samples = (mod * self.sr).astype(int)
-        vibrato_signal = np.zeros_like(self.y)
-        for i in range(len(self.y)):
-            index = i - delay_samples[i]
-            if 0 <= index < len(self.y):
-                vibrato_signal[i] = self.y[index]
-        self.y = vibrato_signal
+        y = np.ascontiguousarray(self.y)
+        n = y.shape[-1]
+        # One delay curve is shared by every channel
+        if numba is not None:
+            mod = np.empty(n, dtype=np.float32)
+            _sine_osc(freq, self.sr, depth, mod)
+            delay_samples = (mod * self.sr).astype(np.int64)
+            vibrato_signal = self._scratch
+            vibrato_signal[...] = 0
+            if y.shape[0] > 1 and n > _PARALLEL_MIN_SAMPLES:
+                _vibrato_gather_parallel(y, delay_samples, vibrato_signal)
+            else:
+                _vibrato_gather(y, delay_samples, vibrato_signal)
+        else:
+            t = np.arange(n, dtype=np.float32) / np.float32(self.sr)
+            mod = np.float32(depth) * np.sin(np.float32(2 * np.pi * freq) * t)
+            delay_samples = (mod * self.sr).astype(np.int64)
+            src = np.arange(n) - delay_samples
+            valid = (src >= 0) & (src < n)
+            np.clip(src, 0, n - 1, out=src)
+            vibrato_signal = np.take(y, src, axis=1, out=self._scratch)
+            vibrato_signal[:, ~valid] = 0
+        self.y, self._scratch = vibrato_signal, y
         
     def change_formants(self, shift_factor=1.2):
         """
         Modify voice character by shifting formants
         shift_factor: factor to shift formants (>1 higher, <1 lower)
         """
-        D = librosa.stft(self.y)
-        D_mag, D_phase = librosa.magphase(D)
-        D_mag_stretched = np.zeros_like(D_mag)
-        for i in range(D_mag.shape[1]):
-            D_mag_stretched[:, i] = np.interp(
-                np.linspace(0, 1, D_mag.shape[0]),
-                np.linspace(0, 1, D_mag.shape[0]),
-                D_mag[:, i]
-            )
-        D_modified = D_mag_stretched * D_phase
-        self.y = librosa.istft(D_modified)
+        nperseg, noverlap = 2048, 1536
+        n = self.y.shape[-1]
+        # Clips shorter than one frame are zero-padded up to it and trimmed afterwards
+        y = np.pad(self.y, ((0, 0), (0, max(0, nperseg - n))))
+        with scifft.set_workers(-1):
+            _, _, D = signal.stft(y, fs=self.sr, window='hann', nperseg=nperseg, noverlap=noverlap)
+        D_mag = np.abs(D)
+        # Resample every frame along the frequency axis at once: output bin k
+        # reads the linearly interpolated magnitude at bin k / shift_factor
+        n_bins = D_mag.shape[-2]
+        key = (n_bins, shift_factor)
+        grid = self._formant_grid_cache.get(key)
+        if grid is None:
+            src_bins = np.arange(n_bins, dtype=np.float32) / np.float32(shift_factor)
+            lo = np.minimum(src_bins.astype(np.int64), n_bins - 1)
+            hi = np.minimum(lo + 1, n_bins - 1)
+            frac = (src_bins - lo)[:, np.newaxis]
+            grid = (lo, hi, frac, src_bins > n_bins - 1)
+            self._formant_grid_cache[key] = grid
+        lo, hi, frac, above_nyquist = grid
+        D_mag_stretched = (1 - frac) * D_mag[..., lo, :] + frac * D_mag[..., hi, :]
+        D_mag_stretched[..., above_nyquist, :] = 0
+        # Rescaling each bin by new/old magnitude keeps its phase without
+        # materializing a separate unit-phase array
+        np.divide(D_mag_stretched, np.maximum(D_mag, 1e-12), out=D_mag_stretched)
+        D *= D_mag_stretched
+        with scifft.set_workers(-1):
+            _, y = signal.istft(D, fs=self.sr, window='hann', nperseg=nperseg, noverlap=noverlap)
+        self.y = np.ascontiguousarray(y[:, :n], dtype=np.float32)
         
     def add_echo(self, delay_time=0.3, decay=0.5):
         """
@@ -78,10 +240,13 @@ class VoiceEffects:
         decay: echo decay factor (0 to 1)
         """
         delay_samples = int(self.sr * delay_time)
-        echo_signal = np.zeros_like(self.y)
-        if delay_samples < len(self.y):
-            echo_signal[delay_samples:] = self.y[:-delay_samples] * decay
-        self.y = self.y + echo_signal
+        n = self.y.shape[-1]
+        if delay_samples < n:
+            # The scaled head is staged in the scratch buffer before the in-place
+            # add, so the tail never reads samples it has already modified
+            head = np.multiply(self.y[:, :n - delay_samples], decay,
+                               out=self._scratch[:, :n - delay_samples])
+            self.y[:, delay_samples:] += head
         
     def add_distortion(self, gain=2.0, threshold=0.5):
         """
@@ -89,15 +254,45 @@ class VoiceEffects:
         gain: input gain
         threshold: clipping threshold
         """
-        distorted = self.y * gain
-        distorted = np.clip(distorted, -threshold, threshold)
-        if np.max(np.abs(distorted)) != 0:
-            distorted = distorted / np.max(np.abs(distorted))
-        self.y = distorted
+        distorted = np.multiply(self.y, gain, out=self._scratch)
+        np.clip(distorted, -threshold, threshold, out=distorted)
+        peak = _absmax(distorted.ravel()) if numba is not None else np.abs(distorted).max()
+        # Flooring the peak keeps silence at zero without branching on it
+        distorted *= 1.0 / max(peak, 1e-12)
+        self.y, self._scratch = distorted, self.y
+        
+    def apply_post_chain(self, delay_time=0.3, decay=0.5, gain=2.0, threshold=0.5):
+        """
+        Apply echo followed by distortion in one fused pass
+        delay_time: echo delay in seconds
+        decay: echo decay factor (0 to 1)
+        gain: input gain
+        threshold: clipping threshold
+        """
+        if numba is None:
+            self.add_echo(delay_time=delay_time, decay=decay)
+            self.add_distortion(gain=gain, threshold=threshold)
+            return
+        delay_samples = int(self.sr * delay_time)
+        y = np.ascontiguousarray(self.y)
+        out = self._scratch
+        if y.shape[0] > 1 and y.shape[1] > _PARALLEL_MIN_SAMPLES:
+            _echo_distort_parallel(y, delay_samples, decay, gain, threshold, out)
+        else:
+            _echo_distort(y, delay_samples, decay, gain, threshold, out)
+        self.y, self._scratch = out, y
         
-    def save(self, output_file):
-        """Save the processed audio"""
-        sf.write(output_file, self.y, self.sr)
+    def save(self, output_file, subtype='FLOAT'):
+        """
+        Save the processed audio
+        subtype: 'FLOAT' writes the float32 samples as-is, 'PCM_16' writes 16-bit integers
+        """
+        if subtype == 'PCM_16':
+            data = np.clip(self.y * 32767, -32768, 32767).astype(np.int16)
+        else:
+            data = self.y
+        # soundfile expects (samples, channels)
+        sf.write(output_file, data.T, self.sr, subtype=subtype)
 
 def process_audio(input_audio,
                   room_size, damping,
@@ -112,8 +307,7 @@ def process_audio(input_audio,
     effects.apply_frequency_filter(cutoff_freq, filter_type=filter_type)
     effects.add_vibrato(freq=vibrato_freq, depth=vibrato_depth)
     effects.change_formants(shift_factor=shift_factor)
-    effects.add_echo(delay_time=delay_time, decay=decay)
-    effects.add_distortion(gain=gain, threshold=threshold)
+    effects.apply_post_chain(delay_time=delay_time, decay=decay, gain=gain, threshold=threshold)
     output_file = "modified_voice.wav"
     effects.save(output_file)
     return output_file